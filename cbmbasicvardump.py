@@ -13,35 +13,88 @@ Further reading:
  * https://www.c64-wiki.com/wiki/Floating_point_arithmetic
 """
 
+import mmap
+import re
+import select
 import struct
 import argparse
 import socket
 import tempfile
 
+#Precompiled formats for the values found in a dump.
+_S_H = struct.Struct("<H")
+_S_BH = struct.Struct("<BH")
+_S_h_be = struct.Struct(">h")
+_S_BI_be = struct.Struct(">BI")
+_S_FN = struct.Struct("<HHB")
+_S_HEADER = struct.Struct("<HHHHHHH")
+#One entry of the scalar variable table: two name bytes and five bytes payload.
+_S_VAR = struct.Struct("<BB5s")
+#Format of the array elements by type character.
+_ELEMENT_FORMATS = {'%': _S_h_be, '$': _S_BH, '': _S_BI_be}
+
+#Runs of unused bytes in Dump.used.
+_UNUSED = re.compile(rb"\x00+")
+#Prompt of the VICE monitor, e.g. "(C:$e5cf) " or "(8:$0300) ".
+_PROMPT = re.compile(rb"\([0-9A-Za-z]+:\$[0-9a-fA-F]{4}\) $")
+
+
+def decode_float(exponent, mantissa):
+    """Decode a floating point number
+
+    The exponent byte is followed by the mantissa in big endian
+    order. Bit 31 of the mantissa is the sign, the implicit leading
+    one bit takes its place.
+
+    @param exponent: exponent byte
+    @param mantissa: mantissa as big endian uint32
+    @return: value as float
+    """
+    if exponent == 0:
+        return 0.0
+    value = (mantissa | 0x80000000) * 2.0**(exponent - 160)
+    if mantissa & 0x80000000:
+        value = -value
+    return value
+
 class Variable(object):
-    """Variable basis class"""
-    def __init__(self, data, pos):
+    """Variable basis class
+
+    Variables keep their decoded fields. String and array variables
+    also keep the dump to look up string contents and to mark the
+    strings as used when printed.
+    """
+    __slots__ = ("pos", "name")
+    def __init__(self, pos, nam0, nam1):
         """Construct a variable
 
-        @param data: memory data
         @param pos: position of variable
+        @param nam0: first byte of the name
+        @param nam1: second byte of the name
         """
-        self.data = data
         self.pos = pos
-        self.name = chr(data[pos] & 0x7f)
-        if data[pos + 1] & 0x7f != 0:
-            self.name += chr(data[pos + 1] & 0x7f)
+        self.name = chr(nam0 & 0x7f)
+        if nam1 & 0x7f != 0:
+            self.name += chr(nam1 & 0x7f)
     def __str__(self):
         "Convert to string."
         raise NotImplementedError("string converter missing")
 
 class IntegerVariable(Variable):
     "Integer variable, signed 16 bit."
-    def __init__(self, data, pos):
-        "Constructor"
-        Variable.__init__(self, data, pos)
+    __slots__ = ("value",)
+    def __init__(self, pos, nam0, nam1, payload, dump):
+        """Constructor
+
+        @param pos: position of variable
+        @param nam0: first byte of the name
+        @param nam1: second byte of the name
+        @param payload: five bytes following the name
+        @param dump: unused, required by Dump.SCALAR_TYPES
+        """
+        Variable.__init__(self, pos, nam0, nam1)
         #Yes, integer variables are stored in big endian.
-        self.value = struct.unpack_from(">h", data, pos + 2)[0]
+        self.value = _S_h_be.unpack_from(payload)[0]
     def __str__(self):
         "Convert to string"
         return "%s%% = %d" % (self.name, self.value)
@@ -54,21 +107,18 @@ class FloatVariable(Variable):
     L. Englisch's book on page 3.
 
     """
-    def __init__(self, data, pos):
-        "Constructor"
-        Variable.__init__(self, data, pos)
-        unp = struct.unpack_from("<BBBBB", data, pos + 2)
-        exponent = unp[0]
-        if exponent == 0:
-            mantissa = 0
-        else:
-            mantissa = unp[1] * 2**(-32)
-            mantissa += unp[2] * 2**(-24)
-            mantissa += unp[3] * 2**(-16)
-            mantissa += (unp[4] | 0x80) * 2**(-8)
-            if unp[4] >= 128:
-                mantissa *= -1
-        self.value = mantissa * 2**(exponent - 128)
+    __slots__ = ("value",)
+    def __init__(self, pos, nam0, nam1, payload, dump):
+        """Constructor
+
+        @param pos: position of variable
+        @param nam0: first byte of the name
+        @param nam1: second byte of the name
+        @param payload: five bytes following the name
+        @param dump: unused, required by Dump.SCALAR_TYPES
+        """
+        Variable.__init__(self, pos, nam0, nam1)
+        self.value = decode_float(*_S_BI_be.unpack_from(payload))
     def __str__(self):
         return "%s = %E" % (self.name, self.value)
 
@@ -82,17 +132,25 @@ class ArrayVariable(Variable):
      - Number of dimensions (uint8).
      - Last dimension (big(!) endian uint16).
      - First dimension (big(!) endian uint16).
+     - The elements: five bytes per float, two bytes (big endian)
+       per integer, three bytes (length and pointer) per string.
 
     The documentation in [Dan Heeb, Compute!`s VIC20 and Commodore 64
     Tool Kit: BASIC, Compute!, 1984, p. 164] seems to be wrong, the
     elements per dimension are stored in big-endian format!
 
+    Only the position and number of the elements are kept, they are
+    unpacked from the dump when printing.
+
     """
-    def __init__(self, data, pos, dump):
-        Variable.__init__(self, data, pos)
+    __slots__ = ("dump", "tchr", "bytes", "dim", "nelems", "start", "count")
+    def __init__(self, pos, dump):
+        data = dump.data
+        base = dump.base_offset
+        Variable.__init__(self, pos, data[base + pos], data[base + pos + 1])
         self.dump = dump
-        ivarfun = self.data[pos] >= 0x80
-        ivarstr = self.data[pos + 1] >= 0x80
+        ivarfun = data[base + pos] >= 0x80
+        ivarstr = data[base + pos + 1] >= 0x80
         if ivarfun and ivarstr:
             self.tchr = '%'
         elif ivarfun:
@@ -101,10 +159,13 @@ class ArrayVariable(Variable):
             self.tchr = '$'
         else:
             self.tchr = ''
-        self.bytes = struct.unpack_from("<H", data, pos + 2)[0]
-        self.dim = struct.unpack_from("B", data, pos + 4)[0]
+        self.bytes = _S_H.unpack_from(data, base + pos + 2)[0]
+        self.dim = data[base + pos + 4]
         #Number of elements per dimension from last to first.
-        self.nelems = [struct.unpack_from(">H", data, pos + 5 + 2*i)[0] for i in range(self.dim)]
+        self.nelems = struct.unpack_from(">%dH" % self.dim, data, base + pos + 5)
+        #Position and number of the elements.
+        self.start = pos + 5 + 2*self.dim
+        self.count = (self.bytes - 5 - 2*self.dim) // _ELEMENT_FORMATS[self.tchr].size
     def __str__(self):
         """Output as a string
 
@@ -114,29 +175,45 @@ class ArrayVariable(Variable):
         """
         nelems = ','.join("%d" % (i - 1) for i in self.nelems)
         res = "%s%s(%s) : %d bytes at $%04X" % (self.name, self.tchr, nelems, self.bytes, self.pos)
+        data = self.dump.data
+        base = self.dump.base_offset
+        fmt = _ELEMENT_FORMATS[self.tchr]
+        start = base + self.start
+        elems = (fmt.unpack_from(data, start + i * fmt.size) for i in range(self.count))
         if self.tchr == '$':
-            strs = []
-            for i in range(0, int((self.bytes - 5 - 2*self.dim)/3)):
-                slen, spos = struct.unpack_from("<BH", self.data, self.pos + 5 + 2*self.dim + 3*i)
-                value = self.data[spos:spos + slen]
+            values = []
+            for slen, spos in elems:
+                value = data[base + spos:base + spos + slen]
                 flag = "*" if spos >= self.dump.fretop else ""
                 if flag == "*":
                     self.dump.mark_used(spos, spos + slen)
-                strs.append("\"%s\"%s" % (str(value, "ascii", errors="replace"), flag))
-            res = f"{res} = [{', '.join(strs)}]"
+                values.append("\"%s\"%s" % (str(value, "ascii", errors="replace"), flag))
+        elif self.tchr == '%':
+            values = ["%d" % i for (i,) in elems]
+        else:
+            values = ["%E" % decode_float(*i) for i in elems]
+        res = f"{res} = [{', '.join(values)}]"
         return res
 
 
 class StringVariable(Variable):
     "String variable"
-    def __init__(self, data, pos, dump):
-        "Constructor"
-        Variable.__init__(self, data, pos)
-        slen, spos = struct.unpack_from("<BH", data, pos +2)
+    __slots__ = ("value", "dump")
+    def __init__(self, pos, nam0, nam1, payload, dump):
+        """Constructor
+
+        @param pos: position of variable
+        @param nam0: first byte of the name
+        @param nam1: second byte of the name
+        @param payload: five bytes following the name
+        @param dump: dump the string is stored in
+        """
+        Variable.__init__(self, pos, nam0, nam1)
+        slen, spos = _S_BH.unpack_from(payload)
         begin = spos
         end = spos + slen
         self.pos = (begin, end)
-        self.value = self.data[spos:spos + slen]
+        self.value = dump.data[dump.base_offset + spos:dump.base_offset + spos + slen]
         self.dump = dump
     def __str__(self):
         "Convert to string for output."
@@ -159,64 +236,121 @@ class BasicFunction(Variable):
     the basic text.
 
     """
-    def __init__(self, data, pos):
-        "Constructor"
-        Variable.__init__(self, data, pos)
+    __slots__ = ("defptr", "varptr", "unknown")
+    def __init__(self, pos, nam0, nam1, payload, dump):
+        """Constructor
+
+        @param pos: position of variable
+        @param nam0: first byte of the name
+        @param nam1: second byte of the name
+        @param payload: five bytes following the name
+        @param dump: unused, required by Dump.SCALAR_TYPES
+        """
+        Variable.__init__(self, pos, nam0, nam1)
+        self.defptr, self.varptr, self.unknown = _S_FN.unpack_from(payload)
     def __str__(self):
         "Convert to string for output."
-        nam0, nam1, defptr, varptr, unknown = struct.unpack_from("<BBHHB", self.data, self.pos)
-        nam0 = chr(nam0 & 0x7f)
-        nam1 = chr(nam1 & 0x7f)
-        out = "DEF FN %c%c @ $%04X = DEF@$%04x VAR@$%04x $%02x" % (nam0, nam1, self.pos, defptr, varptr, unknown)
+        out = "DEF FN %s @ $%04X = DEF@$%04x VAR@$%04x $%02x" % (self.name, self.pos, self.defptr, self.varptr, self.unknown)
         return out
 
 
 class Dump(object):
     """Helper class to handle dumps."""
-    def __init__(self, data):
+    #Scalar variable classes indexed by bit 7 of the first (function)
+    #and second (string) name byte: %00 float, %01 string, %10 DEF
+    #FN, %11 integer. They are all called with (pos, nam0, nam1,
+    #payload, dump), so the classes which do not need the dump still
+    #have to accept it.
+    SCALAR_TYPES = (FloatVariable, StringVariable, BasicFunction, IntegerVariable)
+
+    def __init__(self, data, base_offset=0):
         """Constructor
 
+        The data is not copied, so it may be a mmap of the dump file.
+
         @param data: binary data of dump
+        @param base_offset: offset of address $0000 within data (2 for PRG files)
         """
         self.data = data
-        self.used = bytearray(len(data))
-        self.txttab, self.vartab, self.arytab, self.strend, self.fretop, dummy, self.memsiz = struct.unpack_from("<HHHHHHH", data, 0x2b)
+        self.base_offset = base_offset
+        self.used = bytearray(len(data) - base_offset)
+        self.txttab, self.vartab, self.arytab, self.strend, self.fretop, dummy, self.memsiz = _S_HEADER.unpack_from(data, base_offset + 0x2b)
 
     def read_var(self, pos):
         """Read variable from memory
 
         @param pos: position
         """
-        ivarfun = self.data[pos] >= 0x80
-        ivarstr = self.data[pos + 1] >= 0x80
-        if ivarfun and ivarstr:
-            return IntegerVariable(self.data, pos)
-        elif ivarfun:
-            return BasicFunction(self.data, pos)
-        elif ivarstr:
-            return StringVariable(self.data, pos, self)
-        else:
-            return FloatVariable(self.data, pos)
+        nam0, nam1, payload = _S_VAR.unpack_from(self.data, self.base_offset + pos)
+        return self.make_var(pos, nam0, nam1, payload)
+
+    def read_vars(self):
+        """Read all scalar variables
+
+        The whole variable table from VARTAB to ARYTAB is unpacked in
+        a single pass.
+
+        @return: generator of variables
+        """
+        count = -(-(self.arytab - self.vartab) // _S_VAR.size)
+        start = self.base_offset + self.vartab
+        table = self.data[start:start + count * _S_VAR.size]
+        pos = self.vartab
+        for nam0, nam1, payload in _S_VAR.iter_unpack(table):
+            yield self.make_var(pos, nam0, nam1, payload)
+            pos += _S_VAR.size
+
+    def read_arrays(self):
+        """Read all array variables
+
+        Each array header holds the size of the array, which leads to
+        the next array. A warning is printed if a size is too small to
+        hold the header or if the arrays do not end exactly at STREND.
+
+        @return: generator of array variables
+        """
+        pos = self.arytab
+        while pos < self.strend:
+            size = _S_H.unpack_from(self.data, self.base_offset + pos + 2)[0]
+            if size < 5:
+                print("Warning: invalid array size %d at $%04X" % (size, pos))
+                return
+            yield ArrayVariable(pos, self)
+            pos += size
+        if pos != self.strend:
+            #The dump may have been taken while BASIC was updating the arrays.
+            print("Warning: arrays end at $%04X, STREND is $%04X" % (pos, self.strend))
+
+    def make_var(self, pos, nam0, nam1, payload):
+        """Create variable from an entry of the variable table
+
+        @param pos: position
+        @param nam0: first byte of the name
+        @param nam1: second byte of the name
+        @param payload: five bytes following the name
+        """
+        return self.SCALAR_TYPES[(nam0 >> 7) << 1 | nam1 >> 7](pos, nam0, nam1, payload, self)
 
     def mark_used(self, spos, epos):
-        for i in range(spos, epos):
-            self.used[i] = 1
+        """Mark memory as used by a string
+
+        @param spos: start position
+        @param epos: end position (exclusive)
+        """
+        #Clip at the end of the dump, otherwise the slice assignment would grow the bytearray.
+        epos = min(epos, len(self.used))
+        self.used[spos:epos] = b"\x01" * (epos - spos)
 
     def print_heap_garbage(self):
-        start = None
-        def print_garbage(start, end, data):
-            if start is None:
-                return
-            print("String Heap Garbage [$%04X:$%04X]: \"%s\"" % (start, end, str(data[start:end], "ascii", errors="replace")))
-        for i in range(self.fretop, self.memsiz):
-            if self.used[i] == 1:
-                if start is not None:
-                    print_garbage(start, i, self.data)
-                    start = None
-            else:
-                if start is None:
-                    start = i
-        print_garbage(start, self.memsiz, self.data)
+        """Print the unused parts of the string heap
+
+        Everything between FRETOP and MEMSIZ which was not marked as
+        used will be freed by the next garbage collection.
+        """
+        for match in _UNUSED.finditer(self.used, self.fretop, self.memsiz):
+            start, end = match.span()
+            value = self.data[self.base_offset + start:self.base_offset + end]
+            print("String Heap Garbage [$%04X:$%04X]: \"%s\"" % (start, end, str(value, "ascii", errors="replace")))
 
 
 def parse_args():
@@ -230,21 +364,33 @@ def parse_args():
     return parser.parse_args()
 
 
-def read_socket(sock):
+def read_socket(sock, timeout=5.0):
     """Read from socket
 
-    Read until reading blocks.
+    Read until the monitor prompt is received, the connection is
+    closed or no data arrives within the timeout.
 
+    @param sock: socket connected to the monitor
+    @param timeout: seconds to wait for more data
     @return: read data
     """
-    inp = sock.recv(2048)
+    #Collect the chunks and join them once, appending to a bytes
+    #object would copy everything read so far on each receive.
+    chunks = []
+    tail = b""
     while True:
-        #print("\"%77s\"" % inp)
-        try:
-            inp += sock.recv(2048, socket.MSG_DONTWAIT)
-        except BlockingIOError:
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if not readable:
             break
-    return inp
+        inp = sock.recv(65536)
+        if not inp:
+            break
+        chunks.append(inp)
+        #The prompt may be split across two chunks.
+        tail = (tail + inp)[-16:]
+        if _PROMPT.search(tail):
+            break
+    return b"".join(chunks)
 
 
 def connect(url):
@@ -260,6 +406,10 @@ def connect(url):
         sock.connect((host, int(port)))
         sock.send("r\n".encode())
         read_socket(sock)
+        #If the monitor greeted us with a prompt, the output of "r"
+        #is still pending. Drain it so the next read does not return
+        #early on a stale prompt.
+        read_socket(sock, 0.5)
         sock.send(('bsave "%s" 0 0000 FFFF\n' % tmpf.name).encode())
         read_socket(sock)
         #We get the registers a second time in order to give the
@@ -276,10 +426,23 @@ def analyse_dump(fname):
     @param fname: file name to read dump from
     """
     print("Reading from '%s'." % fname)
-    data = open(fname, "rb").read()
-    if fname.lower().endswith(".prg"):
-        data = data[2:]
-    dump = Dump(data)
+    with open(fname, "rb") as fd:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        #PRG files start with the load address, skip it without copying.
+        base_offset = 2 if fname.lower().endswith(".prg") else 0
+        analyse_data(data, base_offset)
+    finally:
+        data.close()
+
+
+def analyse_data(data, base_offset=0):
+    """Analyse the dump data
+
+    @param data: binary data of dump
+    @param base_offset: offset of address $0000 within data
+    """
+    dump = Dump(data, base_offset)
     print("TXTTAB: Beginning of BASIC program is at $%04x." % dump.txttab)
     print("VARTAB: Variables begin at $%04x." % dump.vartab)
     print("ARYTAB: Array variables begin at $%04x." % dump.arytab)
@@ -289,14 +452,10 @@ def analyse_dump(fname):
     print()
     print("Strings postfixed by a * reside in the string stack.")
     print()
-    for i in range(dump.vartab, dump.arytab, 7):
-        #    print (i, hex(i), data[i:i+8])
-        print(dump.read_var(i))
-    pos = dump.arytab
-    while pos < dump.strend:
-        arr = ArrayVariable(dump.data, pos, dump)
+    for var in dump.read_vars():
+        print(var)
+    for arr in dump.read_arrays():
         print("%s" % arr)
-        pos += arr.bytes
     print()
     dump.print_heap_garbage()
 
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for cbmbasicvardump."""
+
+import math
+import struct
+import unittest
+
+from cbmbasicvardump import decode_float
+
+
+def decode(hexstr):
+    """Decode a float given as the five bytes stored by the C64
+
+    @param hexstr: exponent and mantissa bytes as hex string
+    @return: value as float
+    """
+    return decode_float(*struct.unpack(">BI", bytes.fromhex(hexstr)))
+
+
+class DecodeFloatTest(unittest.TestCase):
+    "Known encodings of the C64 floating point format."
+    def test_one(self):
+        self.assertEqual(decode("8100000000"), 1.0)
+
+    def test_ten(self):
+        self.assertEqual(decode("8420000000"), 10.0)
+
+    def test_negative(self):
+        self.assertEqual(decode("8180000000"), -1.0)
+
+    def test_pi(self):
+        self.assertAlmostEqual(decode("82490FDAA2"), math.pi, places=9)
+
+    def test_zero_exponent(self):
+        self.assertEqual(decode("0000000000"), 0.0)
+        #The mantissa is ignored if the exponent is zero.
+        self.assertEqual(decode("00FFFFFFFF"), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()